@@ -1,16 +1,13 @@
-from re import template
-from torch.nn.modules.activation import GELU
-from transformers import (
-    AutoModel, 
-    AutoTokenizer
-)
+from transformers import AutoModel
 import numpy as np
-import random
 import torch
-from torch import nn, utils, optim
+from torch import nn
 from torch.nn import functional as F
-import os
-from os import path as osp
+
+try:
+    import simsimd
+except ImportError:
+    simsimd = None
 
 """
 SimCSE: Simple Contrastive Learning of Sentence Embeddings
@@ -21,20 +18,40 @@ class UnsupContrastiveLoss(nn.Module):
     """
     Unsupervised Contrastive Loss in paper: 'SimCSE: Simple Contrastive Learning of Sentence Embeddings'
     """
-    def __init__(self, temp):
+    def __init__(self, temp, use_compile=False):
         super().__init__()
         self.temp = temp
+        if use_compile:
+            # let inductor fuse the normalize/matmul/softmax elementwise chain
+            self.compile(dynamic=True)
     
-    def forward(self, first, second):
+    def forward(self, first, second, normalized=False):
         """
         both first and drop are in same dimension [batch_size, hidden], origin is first_pass and second is second_pass
+        normalized: first and second are already L2-normalized, skip normalizing them again
         return loss, sim
         """
-        # using broadcast to calculate similarities, sim[batch_size, batch_size]
-        sim = F.cosine_similarity(first.unsqueeze(1), second.unsqueeze(0), dim=-1) / self.temp
-        label = torch.arange(sim.shape[0]).long().to(sim.device)
-
-        return F.cross_entropy(sim, label), sim
+        if (simsimd is not None and not torch.is_grad_enabled()
+                and first.device.type == 'cpu' and second.device.type == 'cpu'):
+            # cpu evaluation: simsimd's SIMD cosine kernels, no autograd
+            dist = simsimd.cdist(
+                first.detach().float().contiguous().numpy(),
+                second.detach().float().contiguous().numpy(),
+                metric='cosine'
+            )
+            sim = (1 - torch.from_numpy(np.asarray(dist, dtype=np.float32))) / self.temp
+        else:
+            # normalize then matmul to calculate similarities, sim[batch_size, batch_size]
+            # avoids the [batch_size, batch_size, hidden] intermediate of a broadcast cosine_similarity
+            if not normalized:
+                first = F.normalize(first, dim=-1, eps=1e-8)
+                second = F.normalize(second, dim=-1, eps=1e-8)
+            # cast to fp32 before the temperature scaling, keeps softmax denominator in fp32 under autocast
+            sim = torch.matmul(first, second.transpose(0, 1)).float() / self.temp
+
+        # cross entropy with labels arange(batch_size), positives are on the diagonal
+        loss = (torch.logsumexp(sim, dim=1) - sim.diagonal()).mean()
+        return loss, sim
 
 class SupContrastiveLoss(nn.Module):
     """
@@ -49,34 +66,40 @@ class SupContrastiveLoss(nn.Module):
         entail acts as positives or negatives, and contra acts as hard-negatives
         return loss, sim
         """
+        premise = F.normalize(premise, dim=-1, eps=1e-8)
+        #keys [2*batch_size, hidden], entail rows first then contra rows
+        keys = F.normalize(torch.cat([entail, contra], dim=0), dim=-1, eps=1e-8)
 
-        sim_pre_ent = F.cosine_similarity(premise.unsqueeze(1), entail.unsqueeze(0), dim=-1) / self.temp
-        sim_pre_contra = F.cosine_similarity(premise.unsqueeze(1), contra.unsqueeze(0), dim=-1) / self.temp
-        sim_pre_ent_contra = torch.cat(sim_pre_ent, sim_pre_contra, dim=-1)
-        label = torch.arange(sim_pre_ent.shape[0]).long().to(sim_pre_ent.device)
+        #sim_pre_ent_contra [batch_size, 2*batch_size], one GEMM for both blocks
+        #cast to fp32 before the temperature scaling, keeps softmax denominator in fp32 under autocast
+        sim_pre_ent_contra = torch.matmul(premise, keys.transpose(0, 1)).float() / self.temp
 
-        return F.cross_entropy(sim_pre_ent_contra, label), sim_pre_ent_contra
+        # cross entropy with labels arange(batch_size), positives are on the diagonal of the entail block
+        loss = (torch.logsumexp(sim_pre_ent_contra, dim=1) - sim_pre_ent_contra.diagonal()).mean()
+        return loss, sim_pre_ent_contra
 
 
 class UnsupSimCSE(nn.Module):
     """
     Unsupervised SimCSE, using twice dropout to generate data augmentation
     """
-    def __init__(self, pretraind_model, temp=0.05):
+    def __init__(self, pretraind_model, temp=0.05, use_compile=False):
         super().__init__()
         self.temp = temp
-        self.bert = AutoTokenizer.from_pretrained(pretraind_model)
-        self.contra_loss = UnsupContrastiveLoss(self.temp)
+        self.bert = AutoModel.from_pretrained(pretraind_model)
+        self.contra_loss = UnsupContrastiveLoss(self.temp, use_compile=use_compile)
 
     def forward(self, input_ids, attention_mask, token_type_ids=None, labels=None, inputs_embeds=None):
         if input_ids.ndim != 3:
             # input dimension shoule be [batch_size, 2, hidden_dim]
             raise NotImplementedError('input dimension shoule be [batch_size, 2, hidden_dim]')
         batch_size, _, hidden_dim = input_ids.shape
-        flat_input_ids = input_ids.reshape(batch_size*2, hidden_dim)
-        flat_attention_mask = attention_mask.reshape(batch_size*2, hidden_dim)
+        # inputs are contiguous, view is a guaranteed alias without copy
+        flat_input_ids = input_ids.view(-1, hidden_dim)
+        flat_attention_mask = attention_mask.view(-1, hidden_dim)
+        flat_token_type_ids = None
         if token_type_ids is not None:
-            flat_token_type_ids = token_type_ids.reshape(batch_size*2, hidden_dim)
+            flat_token_type_ids = token_type_ids.view(-1, hidden_dim)
         
         pooler_output = self.bert(
             input_ids=flat_input_ids,
@@ -84,8 +107,8 @@ class UnsupSimCSE(nn.Module):
             token_type_ids=flat_token_type_ids
         ).pooler_output
 
-        pooler_output = pooler_output.reshape(batch_size, 2, hidden_dim)
-        first, last = pooler_output[:, 0], pooler_output[:, 1]
+        # unbind returns strided views, no copy; the loss normalizes them into fresh tensors anyway
+        first, last = pooler_output.view(batch_size, 2, -1).unbind(dim=1)
         return self.contra_loss(first, last)
 
 
@@ -96,7 +119,7 @@ class SupSimCSE(nn.Module):
     def __init__(self, pretraind_model, temp=0.05):
         super().__init__()
         self.temp = temp
-        self.bert = AutoTokenizer.from_pretrained(pretraind_model)
+        self.bert = AutoModel.from_pretrained(pretraind_model)
         self.contra_loss = SupContrastiveLoss(self.temp)
 
     def forward(self, input_ids, attention_mask, token_type_ids=None, labels=None, inputs_embeds=None):
@@ -104,10 +127,12 @@ class SupSimCSE(nn.Module):
             # input dimension shoule be [batch_size, 3, hidden_dim]
             raise NotImplementedError('input dimension shoule be [batch_size, 3, hidden_dim]')
         batch_size, _, hidden_dim = input_ids.shape
-        flat_input_ids = input_ids.reshape(batch_size*3, hidden_dim)
-        flat_attention_mask = attention_mask.reshape(batch_size*3, hidden_dim)
+        # inputs are contiguous, view is a guaranteed alias without copy
+        flat_input_ids = input_ids.view(-1, hidden_dim)
+        flat_attention_mask = attention_mask.view(-1, hidden_dim)
+        flat_token_type_ids = None
         if token_type_ids is not None:
-            flat_token_type_ids = token_type_ids.reshape(batch_size*3, hidden_dim)
+            flat_token_type_ids = token_type_ids.view(-1, hidden_dim)
         
         pooler_output = self.bert(
             input_ids=flat_input_ids,
@@ -115,8 +140,8 @@ class SupSimCSE(nn.Module):
             token_type_ids=flat_token_type_ids
         ).pooler_output
 
-        pooler_output = pooler_output.reshape(batch_size, 3, hidden_dim)
-        premise, entail, contra = pooler_output[:, 0], pooler_output[:, 1], pooler_output[:, 2]
+        # unbind returns strided views, no copy; the loss normalizes them into fresh tensors anyway
+        premise, entail, contra = pooler_output.view(batch_size, 3, -1).unbind(dim=1)
         return self.contra_loss(premise, entail, contra)
 
 """
@@ -147,13 +172,15 @@ class WeightedSampler(nn.Module):
     """
     def __init__(self, weights:torch.FloatTensor):
         super().__init__()
-        self.weights = weights
+        # buffer moves with .to(device), no host to device copy per forward
+        self.register_buffer('weights', torch.as_tensor(weights, dtype=torch.float), persistent=False)
     
     def forward(self, hidden_states, weights:torch.FloatTensor =None):
-        if weights is not None:
+        if weights is None:
             w = self.weights
         else:
-            w = weights
+            # caller supplied weights may still live on another device
+            w = weights.to(hidden_states)
         
         if hidden_states.ndim != 3:
             raise NotImplementedError('hidden_states\' dimensions shoule be 3, including(batch, layer, hidden)')
@@ -165,74 +192,95 @@ class WeightedSampler(nn.Module):
         #sum over w == 1, [layer_num]
         w = w / w.sum()
 
-        return torch.sum(
-            hidden_states * w.unsqueeze(0).unsqueeze(-1)
-        )
+        #weighted sum over layers only, [batch_size, hidden_dim]
+        return torch.einsum('blh,l->bh', hidden_states, w)
 
 class SGLossOpt2(nn.Module):
     """
     Exactly the same loss func with Unsupervised SimCSE
     """
-    def __init__(self, temp):
+    def __init__(self, temp, use_compile=False):
         super().__init__()
         self.temp = temp
+        if use_compile:
+            # let inductor fuse the normalize/matmul/softmax elementwise chain
+            self.compile(dynamic=True)
     
-    def forward(self, cls, hidden):
+    def forward(self, cls, hidden, normalized=False):
         """
         both cls and hidden are in same dimension [batch_size, hidden], cls is [cls_token] from BERT_T, hidden is [sampler_out] from BERT_F
+        normalized: cls and hidden are already L2-normalized, skip normalizing them again
         return loss, sim
         """
-        # using broadcast to calculate similarities, sim[batch_size, batch_size]
-        sim = F.cosine_similarity(cls.unsqueeze(1), hidden.unsqueeze(0), dim=-1) / self.temp
-        label = torch.arange(sim.shape[0]).long().to(sim.device)
-
-        return F.cross_entropy(sim, label), sim
+        # normalize then matmul to calculate similarities, sim[batch_size, batch_size]
+        if not normalized:
+            cls = F.normalize(cls, dim=-1, eps=1e-8)
+            hidden = F.normalize(hidden, dim=-1, eps=1e-8)
+        # cast to fp32 before the temperature scaling, keeps softmax denominator in fp32 under autocast
+        sim = torch.matmul(cls, hidden.transpose(0, 1)).float() / self.temp
+
+        # cross entropy with labels arange(batch_size), positives are on the diagonal
+        loss = (torch.logsumexp(sim, dim=1) - sim.diagonal()).mean()
+        return loss, sim
 
 class SGLossOpt3(nn.Module):
     """
     Opt3 loss(SG-opt loss) in "Self-Guided Contrastive Learning for BERT Sentence Representations"
     in this optimize objectives, Sampler is not used    
     """
-    def __init__(self, temp):
+    def __init__(self, temp, max_bs=512, layer_num=12):
         super().__init__()
         self.temp = temp
+        # hmn_mask_bool [max_bs, max_bs*layer_num], True on the self block i*layer_num:(i+1)*layer_num
+        # built once for batch_size <= max_bs, moved to device together with the module
+        self.register_buffer(
+            'hmn_mask_bool',
+            torch.eye(max_bs, dtype=torch.bool).repeat_interleave(layer_num, dim=1),
+            persistent=False
+        )
+        self.max_bs = max_bs
+        self.layer_num = layer_num
     
-    def forward(self, cls, hidden):
+    def forward(self, cls, hidden, normalized=False):
         """
         cls:[batch_size, hidden_dim]
         hidden:[batch_size, layer_num, hidden_dim]
-        return loss, sim
+        normalized: cls and hidden are already L2-normalized, skip normalizing them again
+        return loss, sim. sim [batch_size, batch_size*layer_num] logits, the self blocks are filled with -inf
         """        
 
         if hidden.ndim != 3:
             raise NotImplementedError('hidden_states\' dimensions shoule be 3, including(batch, layer, hidden)')
 
         batch_size, layer_num, hidden_dim = hidden.shape
+        if layer_num != self.layer_num:
+            raise NotImplementedError('hidden_states\' layer_num should be the layer_num given at construction')
+        if batch_size > self.max_bs:
+            raise NotImplementedError('batch_size should not be larger than the max_bs given at construction')
+
+        #hid_flat [batch*layers, hidden_dim], row m*layers+n is h_mn
+        hid_flat = hidden.reshape(batch_size * layer_num, hidden_dim)
+        if normalized:
+            cls_n, hid_n = cls, hid_flat
+        else:
+            cls_n = F.normalize(cls, dim=-1, eps=1e-8)
+            hid_n = F.normalize(hid_flat, dim=-1, eps=1e-8)
 
-        #sim_ci_hik [batch_size, layers]
-        #sim_ci_hmn [batch_size, batch_size, layers]
-        sim_ci_hik = torch.exp(F.cosine_similarity(cls.unsqueeze(1), hidden, dim=-1))
-        sim_ci_hmn = torch.exp(torch.stack([
-            F.cosine_similarity(c_i, hidden, -1) for c_i in cls
-        ], dim=0))
+        #logits [batch, batch*layers], one GEMM for both numerator and denominator
+        logits = (cls_n @ hid_n.transpose(0, 1)).float() / self.temp
 
+        #logits_ik [batch, layers], c_i with its own layers h_i0 ~ h_il
+        #clone the small diagonal blocks, logits is masked in place below
+        logits_ik = torch.diagonal(logits.view(batch_size, batch_size, layer_num), dim1=0, dim2=1).transpose(0, 1).clone()
 
-        #hmn_mask [batch, batch*layers] 每个[batch, batch]里对角线元素之和为1
-        #sim_ci_hmn reshape [batch, batch*layers]
-        hmn_mask = (torch.ones(batch_size, batch_size) - torch.eye(batch_size)).repeat(1, layer_num)
-        sim_ci_hmn = sim_ci_hmn.reshape(batch_size, batch_size * layer_num)
-        
-        sim_after_mask = sim_ci_hmn * hmn_mask
-        #sim_after_mask = sim_after_mask.reshape(batch_size, batch_size, layer_num)
-
-        loss_list = []
-        for i in range(batch_size):
-            for k in range(layer_num):
-                loss_list.append(
-                    - torch.log(sim_ci_hik[i, k]) \
-                    + torch.log(sim_ci_hik[i, k] + sim_after_mask[i].sum())
-                )
-        return torch.stack(loss_list).mean()
+        #hmn_mask [batch, batch*layers], the block-diagonal cache sliced to this batch
+        hmn_mask = self.hmn_mask_bool[:batch_size, :batch_size * layer_num]
+        #log of sum over m != i, all n, [batch, 1]
+        log_neg = torch.logsumexp(logits.masked_fill_(hmn_mask, float('-inf')), dim=1, keepdim=True)
+
+        #-log(exp(a) / (exp(a) + sum(exp(b)))) = logaddexp(a, logsumexp(b)) - a
+        loss = torch.logaddexp(logits_ik, log_neg) - logits_ik
+        return loss.mean(), logits
         
 
 class SGLossOpt3Simplified(nn.Module):
@@ -241,15 +289,19 @@ class SGLossOpt3Simplified(nn.Module):
     In fact, since I couldn't write the loss function in the paper, I simplified it
     in this optimize objectives, Sampler is not used
     """
-    def __init__(self, temp):
+    def __init__(self, temp, use_compile=False):
         super().__init__()
         self.temp = temp
+        if use_compile:
+            # let inductor fuse the einsum/logsumexp chain over [batch, batch, layers]
+            self.compile(dynamic=True)
     
-    def forward(self, cls, hidden):
+    def forward(self, cls, hidden, normalized=False):
         """
         cls:[batch_size, hidden_dim]
         hidden:[batch_size, layer_num, hidden_dim]
-        return loss, sim
+        normalized: cls and hidden are already L2-normalized, skip normalizing them again
+        return loss, sim. sim [batch_size, batch_size, layer_num] logits
         """
 
         if hidden.ndim != 3:
@@ -260,52 +312,41 @@ class SGLossOpt3Simplified(nn.Module):
         #How do I write this loss in terms of matrix operations? Not the for loop.
 
         #step1 计算损失函数的分子
-        #sim_ci_hik [batch_size, layers], 
-        #sim_ci_hik[i] 代表第i个句子中，c_i和h_i0 ~ h_il的相似度
-        sim_ci_hik = torch.exp(F.cosine_similarity(cls.unsqueeze(1), hidden, dim=-1))
+        #logits_num [batch_size, layers], 
+        #logits_num[i] 代表第i个句子中，c_i和h_i0 ~ h_il的相似度
+        if normalized:
+            cls_n, hid_n = cls, hidden
+        else:
+            cls_n = F.normalize(cls, dim=-1, eps=1e-8)
+            hid_n = F.normalize(hidden, dim=-1, eps=1e-8)
+        #cast to fp32 before the temperature scaling, keeps logsumexp in fp32 under autocast
+        logits_num = torch.einsum('bh,blh->bl', cls_n, hid_n).float() / self.temp
 
         #step2 计算损失的分母
-        #sim_ci_hmn [batch_size, batch_size, layers]
-        #sim_ci_hmn[i] 代表第i个句子和其他所有句子所有层的相似度矩阵
-        sim_ci_hmn = torch.exp(torch.stack([
-            F.cosine_similarity(c_i, hidden, -1) for c_i in cls
-        ], dim=0))
-
-        #log(a) + log(b) = log(a*b)
-        #对分子而言， sum over batch and layers： sim_ci_hik所有元素相乘
-        #对分母而言，分两个步骤，由于简化过，sum over layers = sim_ci_hmn[i].sum() ^ k, 其中i是固定的
-        #分母的第二个步骤, sum over batch, 对i进行遍历, prod over (sim_ci_hmn[i].sum() ^ k), i为遍历变量,
-        #之后对上述结果做-log即可
-
-
-        #[batch_size * layers]
-        sim_ci_hik = sim_ci_hik.reshape(-1)
-        loss1 = - torch.log(sim_ci_hik).sum()
-
-        #[batch_size]
-        sum_over_mn = sim_ci_hmn.sum(dim=[1, 2])
-        loss2 = torch.log(sum_over_mn).sum()
-
-        # return -torch.log(
-        #     sim_ci_hik.prod() / (
-        #         sum_over_mn.prod()
-        #     )
-        # )
-        return loss1 + loss2
-
-class RegHiddenLoss(nn.Moduke):
+        #logits_den [batch_size, batch_size, layers]
+        #logits_den[i] 代表第i个句子和其他所有句子所有层的相似度矩阵
+        logits_den = torch.einsum('bh,mlh->bml', cls_n, hid_n).float() / self.temp
+
+        #-log(exp(a) / sum(exp(b))) = logsumexp(b) - a
+        #logsumexp 内部先减去每行最大值, 避免 exp 溢出, 也省去了单独的 exp 与 log 两次遍历
+        #[batch_size, 1]
+        log_sum_over_mn = torch.logsumexp(logits_den.reshape(batch_size, -1), dim=1, keepdim=True)
+
+        return (log_sum_over_mn - logits_num).mean(), logits_den
+
+class RegHiddenLoss(nn.Module):
     def __init__(self):
         super().__init__()
     
     def forward(self, hidden1, hidden2):
         #input: hidden_states(tuple of tensor)
         #output: loss
-        param_list = []
-        for h1, h2 in zip(hidden1, hidden2):
-            h = (h1 - h2).reshape(-1).pow(2).sum()
-            param_list.append(h)
-        
-        return torch.sum(torch.stack(param_list)).sqrt()
+        #foreach kernels handle the whole tensor list at once instead of one launch per tensor
+        diffs = torch._foreach_sub(list(hidden1), list(hidden2))
+        norms = torch._foreach_norm(diffs, 2)
+
+        #L2 norm of the per-tensor L2 norms is the L2 norm of the whole flattened diff
+        return torch.linalg.vector_norm(torch.stack(norms))
 
 class RegLoss(nn.Module):
     def __init__(self):
@@ -314,34 +355,48 @@ class RegLoss(nn.Module):
     def forward(self, param1, param2):
         #input: model.encoder.parameters()
         #output: loss
-        param_list = []
-        for part1, part2 in zip(param1, param2):
-            param = (part1 - part2).reshape(-1).pow(2).sum()
-            param_list.append(param)
-        
-        return torch.sum(torch.stack(param_list)).sqrt()
+        #foreach kernels handle the whole parameter list at once instead of one launch per tensor
+        diffs = torch._foreach_sub(list(param1), list(param2))
+        norms = torch._foreach_norm(diffs, 2)
+
+        #L2 norm of the per-tensor L2 norms is the L2 norm of the whole flattened diff
+        return torch.linalg.vector_norm(torch.stack(norms))
 
 class TotalLoss(nn.Module):
     def __init__(self, sgloss, sampler, regloss, lamb=0.1):
+        super().__init__()
         self.sgloss = sgloss
         self.sampler = sampler
         self.regloss = regloss
-        self.lamb = 0.1
+        self.lamb = lamb
     
     def forward(self, cls, hiddens, p1, p2):
         """
         cls: [batch, hidden]
         hiddens: [batch, layers, hidden]
+        sgloss is called as sgloss(cls_n, hiddens_n, normalized=True) on L2-normalized inputs
+        and must return loss, sim, e.g. UnsupContrastiveLoss, SGLossOpt2, SGLossOpt3, SGLossOpt3Simplified
         """
         if not isinstance(self.sgloss, (SGLossOpt3, SGLossOpt3Simplified)):
             hiddens = self.sampler(hiddens)
+
+        # normalize once here, sgloss skips its own normalization
+        cls_n = F.normalize(cls, dim=-1, eps=1e-8)
+        hiddens_n = F.normalize(hiddens, dim=-1, eps=1e-8)
+
+        sgloss, _ = self.sgloss(cls_n, hiddens_n, normalized=True)
         
-        return self.sgloss(cls, hiddens) + self.lamb * self.regloss(p1, p2)
+        return sgloss + self.lamb * self.regloss(p1, p2)
 
 
 class SelfGuidedContraModel(nn.Module):
-    def __init__(self, model_name, total_loss, hidden):
-        super.__init__()
+    def __init__(self, model_name, total_loss, hidden, use_compile=False, use_amp=False, share_encoder=False):
+        super().__init__()
+        # bf16 autocast on cuda, opt-in since it changes numerics and needs bf16 support
+        self.use_amp = use_amp
+        # share_encoder: take the layer hiddens from the single bertT forward instead of the frozen bertF,
+        # halves encoder FLOPs but the guide then drifts with bertT instead of staying at the initial weights
+        self.share_encoder = share_encoder
         self.bertF = AutoModel.from_pretrained(model_name)
         self.bertT = AutoModel.from_pretrained(model_name)
         self.proj = nn.Sequential(
@@ -350,6 +405,9 @@ class SelfGuidedContraModel(nn.Module):
             nn.Linear(4096, hidden),
             nn.GELU()
         )
+        if use_compile:
+            # in-place compile keeps the state_dict keys, inductor fuses Linear -> GELU -> Linear -> GELU
+            self.proj.compile(dynamic=True)
         self.loss_fn = total_loss
         self._freeze_param()
 
@@ -359,29 +417,58 @@ class SelfGuidedContraModel(nn.Module):
             if 'layer.0' in name:
                 param.requires_grad_(False)
         
-        for name, param in self.bertF.encoder.named_parameters():
-            param.requires_grad_(False)
-
+        # bertF is the frozen reference, including embeddings and pooler
+        self.bertF.requires_grad_(False)
+        # frozen bertF: no dropout masks, deterministic hidden states
+        self.bertF.eval()
+
+    def train(self, mode=True):
+        super().train(mode)
+        # keep the frozen bertF in eval mode
+        self.bertF.eval()
+        return self
+
+    def _layer_hiddens(self, hidden_states):
+        """
+        hidden_states: tuple of [batch_size, seq_len, hidden_dim] from output_hidden_states=True
+        return: [CLS] token of each layer, [batch_size, layers, hidden_dim]
+        """
+        # skip the embedding output, stack once; detached so the hidden-state branch stays frozen
+        return torch.stack([h[:, 0] for h in hidden_states[1:]], dim=1).detach()
 
     def forward(self, input_ids, attention_mask, token_type_ids=None, labels=None, inputs_embeds=None):
-       
-        #[batch_size, hidden_dim]
-        pooler_output = self.bertT(
-            input_ids=input_ids,
-            attention_mask=attention_mask,
-            token_type_ids=token_type_ids
-        ).pooler_output
-        pooler_output = self.proj(pooler_output)
-
-        #[batch_size, layers, hidden_dim]
-        hiddens = self.bertF(
-            input_ids=input_ids,
-            attention_mask=attention_mask,
-            token_type_ids=token_type_ids
-        )
-        hiddens = self.proj(hiddens)
-
-        loss = self.loss_fn(pooler_output, hiddens, self.bertT.parameters(), self.bertF.parameters())
+        # with use_amp, bf16 autocast on cuda for the encoders, proj and similarity matmuls,
+        # the losses cast their logits back to fp32 before softmax
+        with torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=self.use_amp and input_ids.is_cuda):
+            output = self.bertT(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                token_type_ids=token_type_ids,
+                output_hidden_states=self.share_encoder
+            )
+
+            if self.share_encoder:
+                # a single encoder call yields both the pooler output and the hidden states of all layers
+                hidden_states = output.hidden_states
+            else:
+                # bertF is frozen, no need to keep its activations for backward
+                with torch.no_grad():
+                    hidden_states = self.bertF(
+                        input_ids=input_ids,
+                        attention_mask=attention_mask,
+                        token_type_ids=token_type_ids,
+                        output_hidden_states=True
+                    ).hidden_states
+
+            #[batch_size, hidden_dim]
+            pooler_output = self.proj(output.pooler_output)
+
+            #[batch_size, layers, hidden_dim], proj runs once on the flattened [batch_size*layers, hidden_dim]
+            hiddens = self._layer_hiddens(hidden_states)
+            batch_size, layer_num, hidden_dim = hiddens.shape
+            hiddens = self.proj(hiddens.view(batch_size * layer_num, hidden_dim)).view(batch_size, layer_num, -1)
+
+            loss = self.loss_fn(pooler_output, hiddens, self.bertT.parameters(), self.bertF.parameters())
         
         return loss
 
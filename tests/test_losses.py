@@ -0,0 +1,145 @@
+"""
+Compare the vectorized / log-space losses in myModule with brute-force references
+built from the original per-element formulas
+"""
+import os
+import sys
+
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('transformers')
+from torch.nn import functional as F
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import myModule
+
+TEMP = 0.05
+BATCH = 4
+LAYERS = 3
+HIDDEN = 8
+
+
+def _randn(*shape):
+    return torch.randn(*shape, requires_grad=True)
+
+
+def _assert_same_loss_and_grad(loss, ref, inputs):
+    torch.testing.assert_close(loss, ref, rtol=1e-4, atol=1e-5)
+    grads = torch.autograd.grad(loss, inputs, retain_graph=True)
+    ref_grads = torch.autograd.grad(ref, inputs)
+    for g, rg in zip(grads, ref_grads):
+        torch.testing.assert_close(g, rg, rtol=1e-4, atol=1e-5)
+
+
+def _cos(a, b):
+    return F.cosine_similarity(a, b, dim=-1)
+
+
+def _unsup_reference(first, second):
+    sim = _cos(first.unsqueeze(1), second.unsqueeze(0)) / TEMP
+    return F.cross_entropy(sim, torch.arange(sim.shape[0]))
+
+
+def _sg_opt3_reference(cls, hidden):
+    #original per-(i, k) formula, negatives are all layers of every other sentence m != i
+    batch_size, layer_num, _ = hidden.shape
+    loss_list = []
+    for i in range(batch_size):
+        neg = 0
+        for m in range(batch_size):
+            if m == i:
+                continue
+            for n in range(layer_num):
+                neg = neg + torch.exp(_cos(cls[i], hidden[m, n]) / TEMP)
+        for k in range(layer_num):
+            pos = torch.exp(_cos(cls[i], hidden[i, k]) / TEMP)
+            loss_list.append(-torch.log(pos / (pos + neg)))
+    return torch.stack(loss_list).mean()
+
+
+def _sg_opt3_simplified_reference(cls, hidden):
+    #every (i, k) shares the denominator sum over all m, n
+    batch_size, layer_num, _ = hidden.shape
+    loss_list = []
+    for i in range(batch_size):
+        den = 0
+        for m in range(batch_size):
+            for n in range(layer_num):
+                den = den + torch.exp(_cos(cls[i], hidden[m, n]) / TEMP)
+        for k in range(layer_num):
+            pos = torch.exp(_cos(cls[i], hidden[i, k]) / TEMP)
+            loss_list.append(-torch.log(pos / den))
+    return torch.stack(loss_list).mean()
+
+
+def _reg_reference(params1, params2):
+    return sum(((a - b) ** 2).sum() for a, b in zip(params1, params2)).sqrt()
+
+
+def setup_function(function):
+    torch.manual_seed(0)
+
+
+def test_unsup_contrastive_loss():
+    first, second = _randn(BATCH, HIDDEN), _randn(BATCH, HIDDEN)
+    loss, sim = myModule.UnsupContrastiveLoss(TEMP)(first, second)
+    assert sim.shape == (BATCH, BATCH)
+    _assert_same_loss_and_grad(loss, _unsup_reference(first, second), (first, second))
+
+
+def test_sup_contrastive_loss():
+    premise, entail, contra = _randn(BATCH, HIDDEN), _randn(BATCH, HIDDEN), _randn(BATCH, HIDDEN)
+    loss, sim = myModule.SupContrastiveLoss(TEMP)(premise, entail, contra)
+    assert sim.shape == (BATCH, 2 * BATCH)
+
+    ref_sim = torch.cat([
+        _cos(premise.unsqueeze(1), entail.unsqueeze(0)),
+        _cos(premise.unsqueeze(1), contra.unsqueeze(0))
+    ], dim=-1) / TEMP
+    ref = F.cross_entropy(ref_sim, torch.arange(BATCH))
+    _assert_same_loss_and_grad(loss, ref, (premise, entail, contra))
+
+
+def test_sg_loss_opt2():
+    cls, hidden = _randn(BATCH, HIDDEN), _randn(BATCH, HIDDEN)
+    loss, _ = myModule.SGLossOpt2(TEMP)(cls, hidden)
+    _assert_same_loss_and_grad(loss, _unsup_reference(cls, hidden), (cls, hidden))
+
+
+def test_sg_loss_opt3():
+    cls, hidden = _randn(BATCH, HIDDEN), _randn(BATCH, LAYERS, HIDDEN)
+    loss, _ = myModule.SGLossOpt3(TEMP, max_bs=8, layer_num=LAYERS)(cls, hidden)
+    _assert_same_loss_and_grad(loss, _sg_opt3_reference(cls, hidden), (cls, hidden))
+
+
+def test_sg_loss_opt3_rejects_oversized_batch():
+    loss_fn = myModule.SGLossOpt3(TEMP, max_bs=2, layer_num=LAYERS)
+    with pytest.raises(NotImplementedError):
+        loss_fn(torch.randn(BATCH, HIDDEN), torch.randn(BATCH, LAYERS, HIDDEN))
+
+
+def test_sg_loss_opt3_simplified():
+    cls, hidden = _randn(BATCH, HIDDEN), _randn(BATCH, LAYERS, HIDDEN)
+    loss, _ = myModule.SGLossOpt3Simplified(TEMP)(cls, hidden)
+    _assert_same_loss_and_grad(loss, _sg_opt3_simplified_reference(cls, hidden), (cls, hidden))
+
+
+@pytest.mark.parametrize('loss_cls', [myModule.SGLossOpt3, myModule.SGLossOpt3Simplified])
+def test_sg_loss_normalized_inputs(loss_cls):
+    cls, hidden = torch.randn(BATCH, HIDDEN), torch.randn(BATCH, LAYERS, HIDDEN)
+    kwargs = {'layer_num': LAYERS} if loss_cls is myModule.SGLossOpt3 else {}
+    loss_fn = loss_cls(TEMP, **kwargs)
+
+    loss, _ = loss_fn(cls, hidden)
+    loss_n, _ = loss_fn(F.normalize(cls, dim=-1), F.normalize(hidden, dim=-1), normalized=True)
+    torch.testing.assert_close(loss_n, loss, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize('loss_cls', [myModule.RegLoss, myModule.RegHiddenLoss])
+def test_reg_loss(loss_cls):
+    shapes = [(3, 4), (5,), (2, 2, 2)]
+    params1 = [_randn(*shape) for shape in shapes]
+    params2 = [torch.randn(*shape) for shape in shapes]
+    loss = loss_cls()(iter(params1), iter(params2))
+    _assert_same_loss_and_grad(loss, _reg_reference(params1, params2), params1)